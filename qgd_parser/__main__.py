@@ -10,12 +10,13 @@ __version__ = '0.2.4'
 
 # == IMPORTS ==================================================================
 
-from parser import read_shimadzu_qgd
+from parser import warmup
+from convert import HAS_PYARROW, OUTPUT_SUFFIXES, convert_one, convert_one_buffered, list_names
 from pathlib import Path
-import pandas as pd
 import sys
-from datetime import datetime
 import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 
 def ensure_dir(path: Path) -> None:
@@ -23,47 +24,6 @@ def ensure_dir(path: Path) -> None:
     path.mkdir(parents=True, exist_ok=True)
 
 
-def unique_output_path(output_dir: Path, stem: str, suffix: str = ".csv") -> Path:
-    """
-    Build an output path in output_dir using <stem><suffix>.
-    If it already exists, append a timestamp (and, if needed, a counter) to avoid overwriting.
-    """
-    base = output_dir / f"{stem}{suffix}"
-    if not base.exists():
-        return base
-
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    candidate = output_dir / f"{stem}_{timestamp}{suffix}"
-    if not candidate.exists():
-        return candidate
-
-    # Extremely rare: two runs create the same timestamped name; add a counter.
-    counter = 2
-    while True:
-        candidate = output_dir / f"{stem}_{timestamp}_{counter}{suffix}"
-        if not candidate.exists():
-            return candidate
-        counter += 1
-
-
-def convert_one(input_path: Path, output_dir: Path, what: str, data_format: str) -> Path:
-    """
-    Convert one .qgd file to CSV and return the written output path.
-    """
-    inwhat = ["TIC"] if what.upper() == "TIC" else ["MS1"]
-    data_fmt = "long" if data_format.lower() == "long" else "wide"
-    
-    print(f"▶️ Loading {input_path.name}, with options {inwhat}, {data_fmt} ...")
-    result = read_shimadzu_qgd(str(input_path), what=inwhat, data_format=data_fmt)
-
-    # result key matches "MS1" or "TIC"
-    df_result = pd.DataFrame(result[inwhat[0]])
-
-    out_path = unique_output_path(output_dir, input_path.stem, suffix=".csv")
-    df_result.to_csv(out_path, index=True)
-    return out_path
-
-
 def parse_args():
     """
     CLI interface:
@@ -71,6 +31,9 @@ def parse_args():
       - Optional: --input-dir, --output-dir
       - Optional: --file to convert a single file
       - Optional: --what (MS1/TIC), --format (wide/long)
+      - Optional: --fast-io to write CSVs with pyarrow
+      - Optional: --output-format (csv/parquet/feather)
+      - Optional: --jobs for the number of files converted in parallel in batch mode
     """
     parser = argparse.ArgumentParser(description="Convert Shimadzu .qgd files to CSV.")
     parser.add_argument("--input-dir", type=Path, default=Path("input"),
@@ -83,6 +46,12 @@ def parse_args():
                         help="Which data to export (default: MS1)")
     parser.add_argument("--format", dest="data_format", choices=["wide", "long"], default="wide",
                         help="Output table format (default: wide)")
+    parser.add_argument("--fast-io", action="store_true",
+                        help="Write CSVs with pyarrow (much faster for large tables, falls back to pandas if not installed)")
+    parser.add_argument("--output-format", choices=list(OUTPUT_SUFFIXES), default="csv",
+                        help="Output file format, parquet and feather require pyarrow (default: csv)")
+    parser.add_argument("--jobs", type=int, default=max(1, (os.cpu_count() or 1) // 2),
+                        help="Number of files converted in parallel in batch mode (default: half the CPU cores)")
     return parser.parse_args()
 
 
@@ -96,6 +65,15 @@ def main():
     ensure_dir(output_dir)
     ensure_dir(input_dir)  # keeps your previous behavior; also helps users discover where to put files
 
+    if args.fast_io and not HAS_PYARROW:
+        print("⚠️ pyarrow is not installed, --fast-io falls back to pandas.")
+    if args.fast_io and args.output_format != "csv":
+        print(f"⚠️ --fast-io only applies to csv output and is ignored for {args.output_format}.")
+
+    if args.output_format != "csv" and not HAS_PYARROW:
+        print(f"❌ Error: --output-format {args.output_format} requires pyarrow.")
+        sys.exit(1)
+
     # Determine mode: single-file if --file is provided, otherwise batch.
     if args.file:
         # Allow either a full path or a name relative to input_dir
@@ -109,7 +87,8 @@ def main():
             print(f"❌ Error: File '{input_path}' not found.")
             sys.exit(1)
 
-        out_path = convert_one(input_path, output_dir, what=args.what, data_format=args.data_format)
+        out_path = convert_one(input_path, output_dir, what=args.what, data_format=args.data_format,
+                               fast_io=args.fast_io, output_format=args.output_format)
         print(f"✅ Complete. File saved as {out_path}")
         return
 
@@ -119,13 +98,44 @@ def main():
         print(f"❌ No .qgd files found in '{input_dir}'.")
         return
 
-    for input_path in qgd_files:
-        try:
-            out_path = convert_one(input_path, output_dir, what=args.what, data_format=args.data_format)
-            print(f"✅ Converted: {input_path.name} -> {out_path.name}")
-        except Exception as e:
-            # Continue batch even if one file fails
-            print(f"❌ Failed: {input_path.name} ({e})")
+    # Compile the MS parser once up front instead of inside the first conversion (or in every worker)
+    if args.what == "MS1":
+        warmup()
+
+    # List the output folder once instead of checking every output name on disk (slow on network drives)
+    existing = list_names(output_dir)
+    convert_kwargs = dict(what=args.what, data_format=args.data_format,
+                          fast_io=args.fast_io, output_format=args.output_format, existing=existing)
+
+    if args.jobs > 1 and len(qgd_files) > 1:
+        # Files are independent, convert them in parallel worker processes.
+        # Each worker's messages are printed together with its result, so they don't interleave.
+        with ProcessPoolExecutor(max_workers=min(args.jobs, len(qgd_files))) as executor:
+            futures = {executor.submit(convert_one_buffered, input_path, output_dir, **convert_kwargs): input_path
+                       for input_path in qgd_files}
+            for future in as_completed(futures):
+                input_path = futures[future]
+                try:
+                    out_path, messages, error = future.result()
+                except Exception as e:  # the worker process itself failed
+                    out_path, messages, error = None, "", str(e)
+
+                print(messages, end="")
+                if error is None:
+                    existing.add(out_path.name)
+                    print(f"✅ Converted: {input_path.name} -> {out_path.name}")
+                else:
+                    # Continue batch even if one file fails
+                    print(f"❌ Failed: {input_path.name} ({error})")
+    else:
+        for input_path in qgd_files:
+            try:
+                out_path = convert_one(input_path, output_dir, **convert_kwargs)
+                existing.add(out_path.name)
+                print(f"✅ Converted: {input_path.name} -> {out_path.name}")
+            except Exception as e:
+                # Continue batch even if one file fails
+                print(f"❌ Failed: {input_path.name} ({e})")
 
     print("🏆 Batch conversion complete.")
 
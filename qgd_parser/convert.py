@@ -0,0 +1,133 @@
+"""
+Conversion of single .qgd files to CSV, Parquet or Feather.
+
+Kept apart from the CLI in __main__.py, so that worker processes of the parallel batch mode
+can import convert_one (a function in __main__ cannot be pickled under the spawn start method).
+"""
+
+from parser import read_shimadzu_qgd
+from pathlib import Path
+import pandas as pd
+from datetime import datetime
+import os
+import io
+from contextlib import redirect_stdout
+from typing import Optional
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+    HAS_PYARROW = True
+except ImportError:  # pyarrow is optional, --fast-io then falls back to pandas
+    HAS_PYARROW = False
+
+
+def list_names(path: Path) -> set[str]:
+    """Names of all entries in a directory, listed with a single scandir."""
+    with os.scandir(path) as entries:
+        return {entry.name for entry in entries}
+
+
+def unique_output_path(output_dir: Path, stem: str, suffix: str = ".csv", existing: Optional[set[str]] = None) -> Path:
+    """
+    Build an output path in output_dir using <stem><suffix>.
+    If it already exists, append a timestamp (and, if needed, a counter) to avoid overwriting.
+    If given, existing (names in output_dir, see list_names) is checked instead of the file system.
+    """
+    def exists(path: Path) -> bool:
+        return path.name in existing if existing is not None else path.exists()
+
+    base = output_dir / f"{stem}{suffix}"
+    if not exists(base):
+        return base
+
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    candidate = output_dir / f"{stem}_{timestamp}{suffix}"
+    if not exists(candidate):
+        return candidate
+
+    # Extremely rare: two runs create the same timestamped name; add a counter.
+    counter = 2
+    while True:
+        candidate = output_dir / f"{stem}_{timestamp}_{counter}{suffix}"
+        if not exists(candidate):
+            return candidate
+        counter += 1
+
+
+def write_csv(df: pd.DataFrame, out_path: Path, fast_io: bool = False) -> None:
+    """
+    Write df including its index to out_path, using pyarrow's CSV writer if fast_io is set and pyarrow is available.
+    """
+    if not (fast_io and HAS_PYARROW):
+        # Write in row chunks (faster for long tables) with \n line endings on all platforms, like pyarrow.
+        # No float_format: "%.6g" would cut retention times in minutes to 6 significant digits.
+        df.to_csv(out_path, index=True, chunksize=65536, lineterminator="\n")
+        return
+
+    # pyarrow has no index: write it as leading column(s), unnamed like pandas does
+    df_flat = df.rename_axis([name or "" for name in df.index.names]).reset_index()
+    df_flat.columns = [str(c) for c in df_flat.columns]
+    table = pa.Table.from_pandas(df_flat, preserve_index=False)
+    pacsv.write_csv(table, str(out_path), write_options=pacsv.WriteOptions(include_header=True))
+
+
+OUTPUT_SUFFIXES = {"csv": ".csv", "parquet": ".parquet", "feather": ".feather"}
+
+
+def write_output(df: pd.DataFrame, out_path: Path, output_format: str = "csv", fast_io: bool = False) -> None:
+    """
+    Write df to out_path as CSV, Parquet or Feather. Parquet and Feather require pyarrow.
+    """
+    if output_format == "csv":
+        write_csv(df, out_path, fast_io=fast_io)
+        return
+
+    # Both formats need string column names (wide tables have integer m/z columns)
+    df = df.set_axis(df.columns.astype(str), axis=1)
+    if output_format == "parquet":
+        df.to_parquet(out_path, compression="zstd", compression_level=3)
+    else:  # Feather stores no index, keep a real one (retention times) as leading column(s)
+        df.reset_index(drop=isinstance(df.index, pd.RangeIndex)).to_feather(out_path)
+
+
+def convert_one(
+    input_path: Path,
+    output_dir: Path,
+    what: str,
+    data_format: str,
+    fast_io: bool = False,
+    output_format: str = "csv",
+    existing: Optional[set[str]] = None
+) -> Path:
+    """
+    Convert one .qgd file to CSV (or Parquet/Feather) and return the written output path.
+    existing: optional set of names already in output_dir, see unique_output_path.
+    """
+    inwhat = ["TIC"] if what.upper() == "TIC" else ["MS1"]
+    data_fmt = "long" if data_format.lower() == "long" else "wide"
+    
+    print(f"▶️ Loading {input_path.name}, with options {inwhat}, {data_fmt} ...")
+    result = read_shimadzu_qgd(str(input_path), what=inwhat, data_format=data_fmt)
+
+    # result key matches "MS1" or "TIC", formatted data already is a DataFrame
+    df_result = result[inwhat[0]]
+
+    out_path = unique_output_path(output_dir, input_path.stem, suffix=OUTPUT_SUFFIXES[output_format],
+                                  existing=existing)
+    write_output(df_result, out_path, output_format=output_format, fast_io=fast_io)
+    return out_path
+
+
+def convert_one_buffered(input_path: Path, output_dir: Path, **kwargs) -> tuple[Optional[Path], str, Optional[str]]:
+    """
+    Run convert_one with its messages captured, for parallel workers whose output would otherwise interleave.
+    Returns (output path, messages, error); on failure the output path is None and error holds the exception text.
+    """
+    buffer = io.StringIO()
+    with redirect_stdout(buffer):
+        try:
+            out_path, error = convert_one(input_path, output_dir, **kwargs), None
+        except Exception as e:
+            out_path, error = None, str(e)
+    return out_path, buffer.getvalue(), error
@@ -22,54 +22,66 @@ import olefile
 import struct
 import numpy as np
 import pandas as pd
-from io import BytesIO
-from typing import Literal, Union
+from typing import Literal, Optional
 
+try:
+    from numba import njit
+    HAS_NUMBA = True
+except ImportError:  # numba is optional, MS data is then parsed with NumPy only
+    HAS_NUMBA = False
 
-def read_stream(path: str, stream_path: list[str]) -> bytes:
-    with olefile.OleFileIO(path) as ole:
-        stream = '/'.join(stream_path)
-        if ole.exists(stream):
-            return ole.openstream(stream).read()
-        else:
-            raise ValueError(f"Stream {stream} not found in {path}")
+    def njit(*args, **kwargs):
+        return lambda func: func
+
+
+# Column dtypes of the parsed MS data, one row per m/z value of a scan
+# m/z is kept as the raw 2-byte integer (m/z * 20), it is only scaled when formatting
+MS_COLUMNS = {"scan": np.int32, "rt_ms": np.int32, "mz_raw": np.uint16, "intensity": np.int64}
 
+# Retention times are stored in ms, rt / min is a true float64 division by this (not a float32 reciprocal product)
+MS_PER_MIN = 60000.0
 
-def read_retention_times(path: str) -> np.ndarray:
-    raw = read_stream(path, ["GCMS Raw Data", "Retention Time"])
+
+def read_stream(ole: olefile.OleFileIO, stream_path: list[str]) -> bytes:
+    stream = '/'.join(stream_path)
+    if ole.exists(stream):
+        return ole.openstream(stream).read()
+    else:
+        # ole.fp is the file opened from the path given to OleFileIO
+        raise ValueError(f"Stream {stream} not found in {getattr(ole.fp, 'name', 'QGD file')}")
+
+
+def read_retention_times(ole: olefile.OleFileIO) -> np.ndarray:
+    raw = read_stream(ole, ["GCMS Raw Data", "Retention Time"])
     rts = np.frombuffer(raw, dtype='<i4')  # 4-byte little-endian ints
     return rts
 
 
-def read_spectrum_index(path: str) -> list[int]:
+def read_spectrum_index(ole: olefile.OleFileIO) -> np.ndarray:
     """
     Reads the Spectrum Index stream from a Shimadzu QGD file for block size validation.
     Returns an array of position offsets.
     """
-    raw = read_stream(path, ["GCMS Raw Data", "Spectrum Index"])
-    f = BytesIO(raw)
-    offsets = []
-
-    while f.tell() < len(raw):
-        offset = struct.unpack("<I", f.read(4))[0]
-        offsets.append(offset)
+    raw = read_stream(ole, ["GCMS Raw Data", "Spectrum Index"])
+    offsets = np.frombuffer(raw, dtype='<u4')  # 4-byte little-endian unsigned ints
+    return offsets.astype(np.int64)  # signed, so block sizes can be computed by subtraction
 
-    return offsets
 
-
-def read_qgd_tic(path: str) -> dict:
-    raw = read_stream(path, ["GCMS Raw Data", "TIC Data"])
+def read_qgd_tic(ole: olefile.OleFileIO) -> dict:
+    raw = read_stream(ole, ["GCMS Raw Data", "TIC Data"])
     intensities = np.frombuffer(raw, dtype='<i8')  # 8-byte little-endian ints
-    rts = read_retention_times(path)
+    rts = read_retention_times(ole)
     return {"retention_time_ms": rts, "intensity": intensities}
 
 
-def read_ms_block(f, offset_i, offset_next=None, scan_index=None) -> np.ndarray:
-    f.seek(offset_i)
-
+def read_ms_header(raw_ms: bytes, offset_i, offset_next=None, scan_index=None) -> Optional[tuple[int, int, int, int]]:
+    """
+    Reads the 32-byte header of the MS scan at offset_i and validates its block size against the Spectrum Index.
+    Returns (scan, rt_ms, n_bytes, n_val) with a corrected n_bytes, or None if the scan cannot be parsed.
+    """
     try:
         # Read 32-byte header
-        header = f.read(32)
+        header = raw_ms[offset_i:offset_i + 32]
         if len(header) < 32:
             raise ValueError("Incomplete header")
 
@@ -103,66 +115,215 @@ def read_ms_block(f, offset_i, offset_next=None, scan_index=None) -> np.ndarray:
                         f"Check for corruption at offset {offset_i}."
                     )
 
-        # Now read data block
-        data_block = f.read(n_val * (2 + n_bytes))
-        if len(data_block) < n_val * (2 + n_bytes):
+        # Make sure the data block is complete before the output gets allocated
+        if len(raw_ms) - (offset_i + 32) < n_val * (2 + n_bytes):
             raise ValueError(f"Incomplete data block at scan {scan}")
 
-        rows = []
-        i = 0
-        for _ in range(n_val):
-            mz = struct.unpack('<H', data_block[i:i+2])[0] / 20.0 # 2 byte mz, scaled by 20, followed by intensity
-            raw = data_block[i+2:i+2+n_bytes]
-
-            if n_bytes == 4: #Shimadzu has a weird format, where sometimes in the header n_bytes is 1, but actually 4 bytes are used, but only 7 bits of the fourth byte.
-                intensity = int.from_bytes(raw, byteorder='little') & 0x7FFFFFFF
-            
-            else:
-                intensity = int.from_bytes(
-                    data_block[i+2:i+2+n_bytes],
-                    byteorder='little',
-                    signed=False 
-                )
-            rows.append((scan, rt_ms, mz, intensity))
-            i += 2 + n_bytes
-
-        return np.array(rows)
+        return scan, rt_ms, n_bytes, n_val
 
     except Exception as e:
         print(f"[Error] Scan {scan_index or 'unknown'} at offset {offset_i}: {e}")
-        return np.empty((0, 4))
+        return None
+
+
+# Record of a scan with 2-byte intensities, by far the most common case
+_RECORD_U2 = np.dtype([("mz", "<u2"), ("it", "<u2")])
+
 
-def read_qgd_ms(path: str) -> np.ndarray:
+def _split_data_block(data_block: bytes, n_val: int, n_bytes: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Splits a scan's data block into m/z (raw, unscaled) and intensity arrays.
+    3-byte intensities are read as strided 4-byte words, other non-native widths are zero-padded.
+    """
+    if n_bytes == 2:  # fast path, nothing to widen or mask
+        arr = np.frombuffer(data_block, dtype=_RECORD_U2, count=n_val)
+        return arr["mz"], arr["it"]
+
+    if n_bytes in (1, 4, 8):
+        arr = np.frombuffer(data_block, dtype=[("mz", "<u2"), ("it", f"<u{n_bytes}")], count=n_val)
+        intensity = arr["it"]
+    elif n_bytes == 3 and n_val > 0:  # an empty block has no byte 1 to start from
+        arr = np.frombuffer(data_block, dtype=[("mz", "<u2"), ("it", "V3")], count=n_val)
+        # Each 4-byte word from byte 1 of a record holds the high m/z byte plus the 3 intensity bytes,
+        # shifting out the m/z byte leaves the intensity. The word never reaches past the record.
+        words = np.ndarray((n_val,), dtype="<u4", buffer=data_block, offset=1, strides=(5,))
+        intensity = words >> 8
+    else:
+        width = 4 if n_bytes < 4 else 8
+        arr = np.frombuffer(data_block, dtype=[("mz", "<u2"), ("it", f"V{n_bytes}")], count=n_val)
+        padded = np.zeros((n_val, width), dtype=np.uint8)
+        padded[:, :n_bytes] = np.frombuffer(data_block, dtype=np.uint8).reshape(n_val, 2 + n_bytes)[:, 2:]
+        intensity = padded.view(f"<u{width}").ravel()
+
+    if n_bytes == 4: #Shimadzu has a weird format, where sometimes in the header n_bytes is 1, but actually 4 bytes are used, but only 7 bits of the fourth byte.
+        intensity = intensity & 0x7FFFFFFF
+
+    return arr["mz"], intensity
+
+
+def read_qgd_ms(ole: olefile.OleFileIO) -> dict:
     """
     Parses MS1 scan data from a Shimadzu QGD file using Spectrum Index
-    for block size validation. Returns an array of [scan, rt, mz, intensity].
+    for block size validation. Returns a dict of equally long columns scan, rt_ms, mz_raw and intensity, see MS_COLUMNS.
     """
     print(f"Preparing MS data...")
-    raw_ms = read_stream(path, ["GCMS Raw Data", "MS Raw Data"])
-    offsets = read_spectrum_index(path)
+    raw_ms = read_stream(ole, ["GCMS Raw Data", "MS Raw Data"])
+    offsets = read_spectrum_index(ole)
 
-    f = BytesIO(raw_ms)
-    all_blocks = []
-    
     print(f"Reading MS data...")
+    if HAS_NUMBA:
+        return _read_ms_numba(raw_ms, offsets)
+    return _read_ms_numpy(raw_ms, offsets)
+
+
+def _empty_ms_columns(total: int) -> dict:
+    return {name: np.empty(total, dtype=dtype) for name, dtype in MS_COLUMNS.items()}
+
+
+def _read_ms_numpy(raw_ms: bytes, offsets: np.ndarray) -> dict:
+    """
+    Fallback parser without numba: Python loop over the scans, NumPy within each scan.
+    """
+    # Pass 1: headers only, to size the output
+    headers = []
     for i in range(len(offsets)):
         offset_i = offsets[i]
         offset_next = offsets[i + 1] if i < len(offsets) - 1 else None
 
-        block = read_ms_block(f, offset_i, offset_next, scan_index=i)
-        if block.shape[0] > 0:
-            all_blocks.append(block)
+        header = read_ms_header(raw_ms, offset_i, offset_next, scan_index=i)
+        if header is not None and header[3] > 0:
+            headers.append((offset_i, *header))
 
-    return np.vstack(all_blocks) if all_blocks else np.empty((0, 4))
+    out = _empty_ms_columns(sum(h[4] for h in headers))
 
+    # Pass 2: fill the preallocated columns scan by scan
+    data = memoryview(raw_ms)
+    start = 0
+    for offset_i, scan, rt_ms, n_bytes, n_val in headers:
+        end = start + n_val
+        data_block = data[offset_i + 32:offset_i + 32 + n_val * (2 + n_bytes)]
+        # View the m/z -- intensity pairs as one record per value, no per-value unpacking
+        mz_raw, intensity = _split_data_block(data_block, n_val, n_bytes)
+
+        out["scan"][start:end] = scan
+        out["rt_ms"][start:end] = rt_ms
+        out["mz_raw"][start:end] = mz_raw
+        out["intensity"][start:end] = intensity
+        start = end
+
+    return out
+
+
+def _read_ms_numba(raw_ms: bytes, offsets: np.ndarray) -> dict:
+    """
+    Parses all scans in compiled loops. Only scans whose header does not match the Spectrum Index
+    go through read_ms_header, which corrects n_bytes (or skips the scan) and reports it.
+    """
+    raw = np.frombuffer(raw_ms, dtype=np.uint8)
+    n_bytes = np.zeros(len(offsets), dtype=np.int64)
+    n_val = np.zeros(len(offsets), dtype=np.int64)
+
+    # Pass 1: headers only, to size the output
+    flagged = _scan_headers(raw, offsets, n_bytes, n_val)
+    for i in np.flatnonzero(flagged):
+        offset_next = offsets[i + 1] if i < len(offsets) - 1 else None
+        header = read_ms_header(raw_ms, offsets[i], offset_next, scan_index=i)
+        n_bytes[i], n_val[i] = (header[2], header[3]) if header is not None else (0, 0)
+
+    start = np.zeros(len(offsets), dtype=np.int64)
+    np.cumsum(n_val[:-1], out=start[1:])
+    out = _empty_ms_columns(int(n_val.sum()))
+
+    # Pass 2: fill the preallocated columns
+    _parse_all(raw, offsets, n_bytes, n_val, start, out["scan"], out["rt_ms"], out["mz_raw"], out["intensity"])
+    return out
+
+
+def warmup() -> None:
+    """
+    Compiles (or loads the cached) numba kernels on a tiny synthetic scan, so that the first real file
+    does not pay for the compilation. Does nothing without numba.
+    """
+    if not HAS_NUMBA:
+        return
+    # One scan header (scan 0, rt 0, n_bytes 2, n_val 1) followed by a single m/z -- intensity pair
+    raw_ms = struct.pack('<ii12xHH8x', 0, 0, 2, 1) + struct.pack('<HH', 20, 1)
+    _read_ms_numba(raw_ms, np.zeros(1, dtype=np.int64))
+
+
+@njit(cache=True)
+def _read_uint(raw, pos, n):
+    # little-endian unsigned integer of n bytes
+    value = 0
+    for k in range(n):
+        value |= np.int64(raw[pos + k]) << (8 * k)
+    return value
+
+
+@njit(cache=True)
+def _scan_headers(raw, offsets, n_bytes_out, n_val_out):
+    """
+    Reads n_bytes and n_val of every scan header. Returns a mask of scans that are truncated
+    or whose block size does not match the Spectrum Index.
+    """
+    n = len(offsets)
+    flagged = np.zeros(n, dtype=np.bool_)
+    for i in range(n):
+        offset_i = offsets[i]
+        if offset_i + 32 > len(raw):
+            flagged[i] = True
+            continue
+
+        n_bytes = _read_uint(raw, offset_i + 20, 2)
+        n_val = _read_uint(raw, offset_i + 22, 2)
+        block_size = 32 + n_val * (2 + n_bytes)
+
+        if i < n - 1 and block_size != offsets[i + 1] - offset_i:
+            flagged[i] = True
+        elif offset_i + block_size > len(raw):
+            flagged[i] = True
+        else:
+            n_bytes_out[i] = n_bytes
+            n_val_out[i] = n_val
+    return flagged
+
+
+@njit(cache=True)
+def _parse_all(raw, offsets, n_bytes, n_val, start, scan_out, rt_out, mz_raw_out, it_out):
+    """
+    Writes the m/z -- intensity pairs of every scan into the preallocated columns, starting at start[i].
+    """
+    for i in range(len(offsets)):
+        if n_val[i] == 0:
+            continue
+
+        offset_i = offsets[i]
+        first, last = start[i], start[i] + n_val[i]
+        scan_out[first:last] = _read_uint(raw, offset_i, 4)
+        rt_out[first:last] = _read_uint(raw, offset_i + 4, 4)
+        pos = offset_i + 32
+
+        if n_bytes[i] == 2:  # fast path for the most common case, fixed record width
+            for j in range(first, last):
+                mz_raw_out[j] = _read_uint(raw, pos, 2) # 2 byte mz, scaled by 20
+                it_out[j] = _read_uint(raw, pos + 2, 2)
+                pos += 4
+            continue
+
+        # Decided once per scan: with 4 bytes only 7 bits of the fourth byte are used, see _split_data_block
+        mask = 0x7FFFFFFF if n_bytes[i] == 4 else -1
+        for j in range(first, last):
+            mz_raw_out[j] = _read_uint(raw, pos, 2) # 2 byte mz, scaled by 20
+            it_out[j] = _read_uint(raw, pos + 2, n_bytes[i]) & mask
+            pos += 2 + n_bytes[i]
 
 
 def format_chromatogram(
-    data: Union[dict, np.ndarray],
+    data: dict,
     data_format: Literal["long", "wide"] = "wide"
-):
+) -> pd.DataFrame:
     """
-    Formats the output from read_qgd.
+    Formats the output from read_qgd as DataFrame.
     TICs are formatted as retention time in ms and min and total intensity. No long or wide format.
     MS1 data can be given as long or wide tables.
     Long: long table with rows displaying m/z values grouped by scan number
@@ -171,46 +332,81 @@ def format_chromatogram(
         RT (min), RT(ms), total intensity (TIC), intensity for each (rounded) m/z value -> n
     """
     print(f"Formatting data...")
-    if isinstance(data, dict):  # TIC
-        return [{"rt / ms": rt, "rt / min": float(rt / 60000), "intensity": int(it)}
-                for rt, it in zip(data["retention_time_ms"], data["intensity"])]
+    if "retention_time_ms" in data:  # TIC
+        rts = data["retention_time_ms"]
+        return pd.DataFrame({
+            "rt / ms": rts,
+            "rt / min": rts / MS_PER_MIN,
+            "intensity": data["intensity"]
+        })
 
     else:  # MS1 data
-        ms_data = [{"scan": int(s), "rt / ms": int(rt), "rt / min": float(rt / 60000), "mz": float(mz), "intensity": int(it)}
-                    for s, rt, mz, it in data]
         if data_format == "long":
-            return ms_data
+            # m/z as float32 (steps of 0.05), so it is written without float noise.
+            # copy=False: the (writable) parsed columns are used as they are, instead of pandas copying them into blocks.
+            return pd.DataFrame({
+                "scan": data["scan"],
+                "rt / ms": data["rt_ms"],
+                "rt / min": data["rt_ms"] / MS_PER_MIN,
+                "mz": np.divide(data["mz_raw"], 20, dtype=np.float32),
+                "intensity": data["intensity"]
+            }, copy=False)
         else:
-            df_ms1 = pd.DataFrame(ms_data)
-            df_ms1["mz_rounded"] = df_ms1["mz"].round().astype(int)
-            df_ms1["rt / min"] = df_ms1["rt / min"].round(5)
-            df_ms1["intensity"] = df_ms1["intensity"].astype(int)
-
-            # Pivot to matrix (RT × m/z), intensity summed per bin
-            pivot = df_ms1.pivot_table(
-                index=["rt / min", "rt / ms"],
-                columns="mz_rounded",
-                values="intensity",
-                aggfunc="sum"
-            ).fillna(0).astype(int)
-
-            # Calculate total intensity for each RT
-            pivot["total_intensity"] = pivot.sum(axis=1)
-
-            #move total intensity to column 2
-            cols = pivot.columns.tolist()
-            cols = [c for c in cols if c != "total_intensity"]
-            pivot = pivot[["total_intensity"] + cols]
+            # Nearest integer m/z straight from the raw values, ties (x.5) to even like np.round.
+            # Computed in place on a single int32 copy.
+            tie = data["mz_raw"] % 20 == 10
+            mz_rounded = data["mz_raw"].astype(np.int32)
+            mz_rounded += 10
+            mz_rounded //= 20
+            mz_rounded -= tie & (mz_rounded % 2 == 1)
+
+            # Integer codes of RT rows and m/z columns, levels sorted like a pivot table
+            row_idx, rt_levels = _rt_codes(data["rt_ms"])
+            # The m/z range is small (at most 65535 / 20): a lookup table maps each present m/z to its column
+            present = np.bincount(mz_rounded) > 0
+            mz_levels = np.flatnonzero(present)
+            col_idx = (np.cumsum(present) - 1)[mz_rounded]
+
+            # Matrix (RT × m/z), intensity summed per bin
+            mat = np.zeros((len(rt_levels), len(mz_levels)), dtype=np.int64)
+            np.add.at(mat, (row_idx, col_idx), data["intensity"])
+
+            index = pd.MultiIndex.from_arrays(
+                [np.round(rt_levels / MS_PER_MIN, 5), rt_levels],
+                names=["rt / min", "rt / ms"]
+            )
+            pivot = pd.DataFrame(mat, index=index, columns=mz_levels)
+
+            # Total intensity for each RT as column 2
+            pivot.insert(0, "total_intensity", mat.sum(axis=1))
             return pivot
 
+
+def _rt_codes(rt_ms: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the row code of every value and the sorted unique retention times.
+    Scans are normally stored in RT order, then the codes are a running count of RT changes (no sort or hashing).
+    """
+    if np.all(rt_ms[1:] >= rt_ms[:-1]):
+        new_rt = np.empty(len(rt_ms), dtype=bool)
+        new_rt[:1] = True
+        np.not_equal(rt_ms[1:], rt_ms[:-1], out=new_rt[1:])
+        return np.cumsum(new_rt) - 1, rt_ms[new_rt]
+
+    rt_levels, row_idx = np.unique(rt_ms, return_inverse=True)
+    return row_idx, rt_levels
+
+
 def read_shimadzu_qgd(
     path: str,
     what: list[str] = ["MS1", "TIC"],
     data_format: Literal["wide", "long"] = "wide"
 ) -> dict:
     result = {}
-    if "TIC" in what:
-        result["TIC"] = format_chromatogram(read_qgd_tic(path), data_format)
-    if "MS1" in what:
-        result["MS1"] = format_chromatogram(read_qgd_ms(path), data_format)
+    # Open the OLE container once, all streams are read from it
+    with olefile.OleFileIO(path) as ole:
+        if "TIC" in what:
+            result["TIC"] = format_chromatogram(read_qgd_tic(ole), data_format)
+        if "MS1" in what:
+            result["MS1"] = format_chromatogram(read_qgd_ms(ole), data_format)
     return result